@@ -1,43 +1,87 @@
 # app/main.py
-import subprocess
+import asyncio
+import ipaddress
 import logging
-import sys
+import socket
 import os
-from datetime import datetime, timedelta
-from typing import Optional
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import RedirectResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, HTMLResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth
+import jinja2
+import orjson
 import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 import httpx
 
-# Ajouter le répertoire parent au path pour importer scripts
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
 from config.settings import settings
 from config.theme import theme, get_css_variables
 from scripts.pfsense_api import PfSenseAPI, init_pfsense_client, get_pfsense_client
+from scripts.neighbors import NeighborTable, ArpCache
+from scripts.nft import apply_elements, NftBatcher
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# FastAPI app
-app = FastAPI(title=settings.app_name)
-app.add_middleware(SessionMiddleware, secret_key=settings.secret_key)
-
-# Templates
-templates = Jinja2Templates(directory="templates")
+# Templates : pas de stat() des fichiers à chaque rendu hors debug,
+# bytecode compilé partagé entre les workers
+templates = Jinja2Templates(env=jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"),
+    autoescape=True,
+    auto_reload=settings.debug,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(settings.jinja_cache_dir),
+    cache_size=400
+))
+
+# Contexte commun à toutes les pages (le thème ne change pas à l'exécution)
+TEMPLATE_CONTEXT_DEFAULTS = {
+    "theme": theme,
+    "css_variables": get_css_variables()
+}
 
 # Fichiers statiques (logo, favicon, etc.)
 from fastapi.staticfiles import StaticFiles
 
-# Redis client
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles avec un Cache-Control longue durée (logo, favicon, CSS)."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = f"public, max-age={settings.static_max_age}, immutable"
+        return response
+
+
+STATIC_DIR = Path(__file__).resolve().parents[1] / "static"
+
+# Redis client (pool explicite partagé par toutes les requêtes)
+redis_pool: Optional[redis.ConnectionPool] = None
 redis_client: Optional[redis.Redis] = None
 
+# Table des voisins (netlink) pour la résolution IP -> MAC
+neighbor_table: Optional[NeighborTable] = None
+arp_cache = ArpCache(maxsize=settings.arp_cache_size, ttl=settings.arp_cache_ttl)
+# Instantané de la table ARP, rafraîchi en tâche de fond
+arp_table: Dict[str, str] = {}
+arp_refresh_task: Optional[asyncio.Task] = None
+
+# Regroupement des ajouts nftables (initialisé au démarrage si configuré)
+nft_batcher: Optional[NftBatcher] = None
+
+# Client RADIUS CoA (initialisé au démarrage si configuré)
+radius_client = None
+radius_lock = asyncio.Lock()
+
 # OAuth setup
 oauth = OAuth()
 oauth.register(
@@ -48,16 +92,95 @@ oauth.register(
     client_kwargs={"scope": "openid profile email"}
 )
 
+# Métadonnées OIDC + JWKS partagées entre workers via Redis
+OIDC_CACHE_KEY = "oidc:server_metadata"
+oidc_refresh_task: Optional[asyncio.Task] = None
+
+
+async def refresh_oidc_cache():
+    """Recharge métadonnées et JWKS depuis Keycloak et les publie dans Redis."""
+    client = oauth.keycloak
+    client.server_metadata.pop("_loaded_at", None)
+    await client.load_server_metadata()
+    await client.fetch_jwk_set(force=True)
+    await redis_client.set(
+        OIDC_CACHE_KEY,
+        orjson.dumps(client.server_metadata),
+        ex=settings.oidc_cache_ttl
+    )
+
 
-@app.on_event("startup")
-async def startup():
-    global redis_client
-    redis_client = redis.from_url(settings.redis_url, decode_responses=True)
+async def load_oidc_cache() -> bool:
+    """Charge métadonnées et JWKS depuis Redis. Retourne False si absents."""
+    cached = await redis_client.get(OIDC_CACHE_KEY)
+    if not cached:
+        return False
+    # authlib ne refait aucun appel réseau tant que '_loaded_at' et 'jwks' sont présents
+    oauth.keycloak.server_metadata.update(orjson.loads(cached))
+    return True
+
+
+async def oidc_cache_refresher():
+    """Rafraîchit le cache OIDC en tâche de fond (rotation des clés)."""
+    while True:
+        await asyncio.sleep(settings.oidc_cache_ttl / 2)
+        try:
+            # Un autre worker a peut-être déjà rafraîchi : reprendre sa version
+            if await redis_client.ttl(OIDC_CACHE_KEY) > settings.oidc_cache_ttl / 2:
+                await load_oidc_cache()
+            else:
+                await refresh_oidc_cache()
+        except Exception as e:
+            logger.error(f"Erreur rafraîchissement cache OIDC: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Démarrage/arrêt : initialise les clients partagés puis les ferme proprement."""
+    global redis_pool, redis_client, neighbor_table, nft_batcher
+    global arp_refresh_task, oidc_refresh_task
+    redis_pool = redis.ConnectionPool.from_url(
+        settings.redis_url,
+        max_connections=settings.redis_max_connections,
+        decode_responses=True,
+        socket_keepalive=True,
+        health_check_interval=settings.redis_health_check_interval,
+        retry=Retry(ExponentialBackoff(), 3)
+    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
+
+    # Éviter le fetch métadonnées/JWKS sur le premier callback de chaque worker
+    try:
+        if not await load_oidc_cache():
+            await refresh_oidc_cache()
+    except Exception as e:
+        logger.warning(f"Cache OIDC indisponible, chargement au premier login: {e}")
+    oidc_refresh_task = asyncio.create_task(oidc_cache_refresher())
+
+    # Socket netlink partagée pour les lookups ARP (inutile en mode dev)
+    if not settings.dev_mode:
+        try:
+            neighbor_table = NeighborTable(settings.network_interface)
+            if settings.arp_refresh_interval > 0:
+                arp_refresh_task = asyncio.create_task(refresh_arp_table())
+        except OSError as e:
+            logger.error(f"Impossible d'ouvrir la table ARP sur {settings.network_interface}: {e}")
+
+    # Regrouper les ajouts nftables concurrents en une seule transaction
+    if settings.auth_method == "nftables" and not settings.dev_mode:
+        nft_batcher = NftBatcher(
+            settings.nft_table, settings.nft_chain, settings.nft_set,
+            window=settings.nft_batch_window_ms / 1000,
+            max_batch=settings.nft_batch_max
+        )
+        nft_batcher.start()
 
-    # Monter les fichiers statiques
-    static_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
-    if os.path.exists(static_dir):
-        app.mount("/static", StaticFiles(directory=static_dir), name="static")
+    # Initialiser le client RADIUS CoA si configuré
+    if settings.auth_method == "radius_coa":
+        try:
+            init_radius_client()
+        except Exception as e:
+            logger.error(f"Impossible d'initialiser le client RADIUS: {e}")
 
     # Initialiser le client pfSense si configuré
     if settings.auth_method == "pfsense":
@@ -79,11 +202,41 @@ async def startup():
 
     logger.info(f"Portail captif démarré - Méthode auth: {settings.auth_method}")
 
+    try:
+        yield
+    finally:
+        # Arrêter les tâches de fond avant de fermer les clients qu'elles utilisent
+        for task in (oidc_refresh_task, arp_refresh_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        # Appliquer les autorisations nftables encore en file
+        if nft_batcher:
+            await nft_batcher.close()
+        pfsense = get_pfsense_client()
+        if pfsense:
+            await pfsense.aclose()
+        if redis_client:
+            await redis_client.close()
+        if redis_pool:
+            await redis_pool.disconnect()
+        if neighbor_table:
+            neighbor_table.close()
+
+
+# FastAPI app
+app = FastAPI(
+    title=settings.app_name,
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
+app.add_middleware(SessionMiddleware, secret_key=settings.secret_key)
 
-@app.on_event("shutdown")
-async def shutdown():
-    if redis_client:
-        await redis_client.close()
+if STATIC_DIR.is_dir():
+    app.mount("/static", CachedStaticFiles(directory=STATIC_DIR, html=False), name="static")
 
 
 # ============================================
@@ -93,41 +246,69 @@ async def shutdown():
 def generate_fake_mac(ip: str) -> str:
     """Génère une MAC fictive basée sur l'IP (pour mode dev uniquement)."""
     # Utilise les octets de l'IP pour générer une MAC déterministe
-    parts = ip.split(".")
+    raw = socket.inet_aton(ip)
     # Préfixe DE:AD:BE:EF pour identifier les MAC fictives
-    return f"DE:AD:BE:EF:{int(parts[2]):02X}:{int(parts[3]):02X}"
+    return f"DE:AD:BE:EF:{raw[2]:02X}:{raw[3]:02X}"
 
 
-def get_mac_from_ip(ip: str) -> Optional[str]:
-    """Récupère l'adresse MAC depuis la table ARP."""
+async def get_mac_from_ip(ip: str) -> Optional[str]:
+    """Récupère l'adresse MAC depuis la table ARP (netlink RTM_GETNEIGH)."""
     # Mode dev : générer une MAC fictive pour les tests
     if settings.dev_mode:
         fake_mac = generate_fake_mac(ip)
         logger.info(f"[DEV MODE] MAC fictive générée pour {ip}: {fake_mac}")
         return fake_mac
 
+    if not neighbor_table:
+        logger.error("Table ARP netlink non initialisée")
+        return None
+
+    mac = arp_cache.get(ip) or arp_table.get(ip)
+    if mac:
+        return mac
+
     try:
-        result = subprocess.run(
-            ["ip", "neigh", "show", ip],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        # Format: "192.168.1.10 dev eth0 lladdr aa:bb:cc:dd:ee:ff REACHABLE"
-        parts = result.stdout.strip().split()
-        if "lladdr" in parts:
-            mac_index = parts.index("lladdr") + 1
-            return parts[mac_index].upper()
+        mac = await neighbor_table.lookup(ip)
+        # Ne pas mémoriser les échecs : le client peut apparaître juste après
+        if mac:
+            arp_cache.set(ip, mac)
+        return mac
     except Exception as e:
         logger.error(f"Erreur ARP lookup pour {ip}: {e}")
     return None
 
 
+async def refresh_arp_table():
+    """Recharge périodiquement toute la table ARP (un dump netlink par intervalle)."""
+    global arp_table
+    while True:
+        try:
+            arp_table = await neighbor_table.dump()
+        except Exception as e:
+            logger.error(f"Erreur rafraîchissement table ARP: {e}")
+        await asyncio.sleep(settings.arp_refresh_interval)
+
+
+@lru_cache(maxsize=4096)
+def is_valid_ip(ip: str) -> bool:
+    """Vérifie qu'une chaîne est une adresse IPv4/IPv6 valide."""
+    try:
+        ipaddress.ip_address(ip)
+        return True
+    except ValueError:
+        return False
+
+
 def get_client_ip(request: Request) -> str:
     """Récupère l'IP client (gère les proxies)."""
     forwarded = request.headers.get("X-Forwarded-For")
     if forwarded:
-        return forwarded.split(",")[0].strip()
+        # nginx ($proxy_add_x_forwarded_for) conserve les valeurs envoyées par
+        # le client et ajoute l'adresse réelle en dernier : seul le dernier
+        # saut est fiable, les précédents peuvent être forgés
+        ip = forwarded.rpartition(",")[2].strip()
+        if is_valid_ip(ip):
+            return ip
     return request.client.host
 
 
@@ -138,19 +319,12 @@ def get_client_ip(request: Request) -> str:
 async def authorize_mac_nftables(mac: str, username: str) -> bool:
     """Autorise une MAC via nftables."""
     try:
-        # Ajouter au set nftables
-        cmd = [
-            "nft", "add", "element",
-            settings.nft_table, settings.nft_chain,
-            settings.nft_set, "{", mac, "}"
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-        
-        if result.returncode == 0:
+        # Ajouter au set nftables (transaction partagée avec les logins concurrents)
+        if await nft_batcher.add(mac):
             logger.info(f"MAC {mac} autorisée (nftables) pour {username}")
             return True
         else:
-            logger.error(f"Erreur nftables: {result.stderr}")
+            logger.error(f"Erreur nftables pour {mac}")
             return False
     except Exception as e:
         logger.error(f"Exception nftables: {e}")
@@ -160,14 +334,11 @@ async def authorize_mac_nftables(mac: str, username: str) -> bool:
 async def revoke_mac_nftables(mac: str) -> bool:
     """Révoque une MAC via nftables."""
     try:
-        cmd = [
-            "nft", "delete", "element",
-            settings.nft_table, settings.nft_chain,
-            settings.nft_set, "{", mac, "}"
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        results = await apply_elements(
+            "delete", settings.nft_table, settings.nft_chain, settings.nft_set, [mac]
+        )
         
-        if result.returncode == 0:
+        if results.get(mac):
             logger.info(f"MAC {mac} révoquée (nftables)")
             return True
         return False
@@ -176,31 +347,44 @@ async def revoke_mac_nftables(mac: str) -> bool:
         return False
 
 
+def init_radius_client():
+    """Charge le dictionnaire RADIUS et crée le client CoA partagé."""
+    global radius_client
+    from pyrad.client import Client
+    from pyrad import dictionary
+
+    # Charger le dictionnaire RADIUS (une seule fois, $INCLUDE compris)
+    radius_dict = dictionary.Dictionary(settings.radius_dictionary)
+
+    # Créer le client CoA
+    radius_client = Client(
+        server=settings.radius_nas_ip,
+        secret=settings.radius_secret.encode(),
+        dict=radius_dict,
+        coaport=settings.radius_coa_port
+    )
+    radius_client.timeout = 5
+
+
 async def authorize_mac_radius_coa(mac: str, username: str) -> bool:
     """Autorise via RADIUS Change of Authorization."""
     try:
-        from pyrad.client import Client
-        from pyrad import dictionary, packet
-
-        # Charger le dictionnaire RADIUS
-        dict_path = "/etc/freeradius/3.0/dictionary"
-        radius_dict = dictionary.Dictionary(dict_path)
-
-        # Créer le client CoA
-        client = Client(
-            server=settings.radius_nas_ip,
-            secret=settings.radius_secret.encode(),
-            dict=radius_dict
-        )
-        client.timeout = 5
+        from pyrad import packet
+
+        if not radius_client:
+            logger.error("Client RADIUS non initialisé")
+            return False
 
         # Créer le paquet CoA
-        req = client.CreateCoAPacket()
+        req = radius_client.CreateCoAPacket()
         req["User-Name"] = username
         req["Calling-Station-Id"] = mac.replace(":", "-")
 
-        # Envoyer
-        reply = client.SendPacket(req)
+        # Envoyer (bloquant : exécuté hors de la boucle asyncio). La socket
+        # du client est partagée, on sérialise pour ne pas mélanger les réponses.
+        loop = asyncio.get_running_loop()
+        async with radius_lock:
+            reply = await loop.run_in_executor(None, radius_client.SendPacket, req)
 
         if reply.code == packet.CoAACK:
             logger.info(f"CoA ACK reçu pour {mac} ({username})")
@@ -255,71 +439,136 @@ async def revoke_ip_pfsense(ip: str) -> bool:
         return False
 
 
+# ============================================
+# Sélection du backend (résolue une fois, auth_method est fixe)
+# ============================================
+
+async def _authorize_nftables(mac: str, username: str, client_ip: Optional[str]) -> bool:
+    return await authorize_mac_nftables(mac, username)
+
+
+async def _authorize_radius_coa(mac: str, username: str, client_ip: Optional[str]) -> bool:
+    return await authorize_mac_radius_coa(mac, username)
+
+
+async def _authorize_pfsense(mac: str, username: str, client_ip: Optional[str]) -> bool:
+    if not client_ip:
+        logger.error("pfSense requiert l'IP du client")
+        return False
+    return await authorize_ip_pfsense(client_ip, username)
+
+
+async def _authorize_dev(mac: str, username: str, client_ip: Optional[str]) -> bool:
+    # Mode dev : on skip l'autorisation réseau réelle
+    logger.info(f"[DEV MODE] Autorisation simulée pour {mac} / {client_ip} ({username})")
+    return True
+
+
+async def _authorize_unknown(mac: str, username: str, client_ip: Optional[str]) -> bool:
+    logger.error(f"Méthode d'auth inconnue: {settings.auth_method}")
+    return False
+
+
+async def _revoke_nftables(mac: str, client_ip: Optional[str]) -> bool:
+    return await revoke_mac_nftables(mac)
+
+
+async def _revoke_pfsense(mac: str, client_ip: Optional[str]) -> bool:
+    if client_ip:
+        return await revoke_ip_pfsense(client_ip)
+    logger.warning("Révocation pfSense sans IP - ignorée")
+    return True
+
+
+async def _revoke_dev(mac: str, client_ip: Optional[str]) -> bool:
+    # Mode dev : on skip la révocation réseau réelle
+    logger.info(f"[DEV MODE] Révocation simulée pour {mac} / {client_ip}")
+    return True
+
+
+async def _revoke_noop(mac: str, client_ip: Optional[str]) -> bool:
+    # CoA disconnect serait ici pour RADIUS
+    return True
+
+
+AUTHORIZE_BACKENDS = {
+    "nftables": _authorize_nftables,
+    "radius_coa": _authorize_radius_coa,
+    "pfsense": _authorize_pfsense,
+}
+
+REVOKE_BACKENDS = {
+    "nftables": _revoke_nftables,
+    "pfsense": _revoke_pfsense,
+}
+
+if settings.dev_mode:
+    AUTHORIZE_FN = _authorize_dev
+    REVOKE_FN = _revoke_dev
+else:
+    AUTHORIZE_FN = AUTHORIZE_BACKENDS.get(settings.auth_method, _authorize_unknown)
+    REVOKE_FN = REVOKE_BACKENDS.get(settings.auth_method, _revoke_noop)
+
+
+async def get_session_fields(mac: str, *fields: str) -> List[Optional[str]]:
+    """
+    Lit des champs du hash session:{mac}.
+
+    Une clé écrite par une version antérieure (chaîne "user:date:ip") lève
+    WRONGTYPE : la session est alors traitée comme absente, elle sera
+    remplacée au prochain login ou expirera avec son TTL.
+    """
+    try:
+        return await redis_client.hmget(f"session:{mac}", *fields)
+    except redis.ResponseError as e:
+        if not str(e).startswith("WRONGTYPE"):
+            raise
+        logger.warning(f"Session au format obsolète ignorée: {mac}")
+        return [None] * len(fields)
+
+
 async def authorize_mac(mac: str, username: str, client_ip: str = None) -> bool:
     """Autorise une MAC selon la méthode configurée."""
     # Stocker dans Redis avec TTL (inclure l'IP pour pfSense)
-    session_data = f"{username}:{datetime.utcnow().isoformat()}:{client_ip or ''}"
-    await redis_client.setex(
-        f"session:{mac}",
-        settings.session_timeout,
-        session_data
-    )
+    session_data = {
+        "username": username,
+        "since": int(time.time()),
+        "ip": client_ip or ""
+    }
+    async with redis_client.pipeline(transaction=True) as pipe:
+        # Remplacer la session existante plutôt que fusionner les champs
+        pipe.delete(f"session:{mac}")
+        pipe.hset(f"session:{mac}", mapping=session_data)
+        pipe.expire(f"session:{mac}", settings.session_timeout)
+
+        # Si on a une IP, stocker aussi le mapping IP -> MACs pour la révocation
+        # (un set : plusieurs appareils peuvent se succéder sur la même IP)
+        if client_ip:
+            pipe.sadd(f"ip_sessions:{client_ip}", mac)
+            pipe.expire(f"ip_sessions:{client_ip}", settings.session_timeout)
 
-    # Si on a une IP, stocker aussi le mapping IP -> MAC pour la révocation
-    if client_ip:
-        await redis_client.setex(
-            f"ip_session:{client_ip}",
-            settings.session_timeout,
-            mac
-        )
+        await pipe.execute()
 
-    # Mode dev : on skip l'autorisation réseau réelle
-    if settings.dev_mode:
-        logger.info(f"[DEV MODE] Autorisation simulée pour {mac} / {client_ip} ({username})")
-        return True
-
-    if settings.auth_method == "nftables":
-        return await authorize_mac_nftables(mac, username)
-    elif settings.auth_method == "radius_coa":
-        return await authorize_mac_radius_coa(mac, username)
-    elif settings.auth_method == "pfsense":
-        if not client_ip:
-            logger.error("pfSense requiert l'IP du client")
-            return False
-        return await authorize_ip_pfsense(client_ip, username)
-    else:
-        logger.error(f"Méthode d'auth inconnue: {settings.auth_method}")
-        return False
+    return await AUTHORIZE_FN(mac, username, client_ip)
 
 
 async def revoke_mac(mac: str, client_ip: str = None) -> bool:
     """Révoque une MAC."""
     # Récupérer l'IP depuis Redis si non fournie
     if not client_ip:
-        session_data = await redis_client.get(f"session:{mac}")
-        if session_data:
-            parts = session_data.split(":")
-            if len(parts) >= 3:
-                client_ip = parts[2] if parts[2] else None
+        client_ip = (await get_session_fields(mac, "ip"))[0] or None
 
-    await redis_client.delete(f"session:{mac}")
-    if client_ip:
-        await redis_client.delete(f"ip_session:{client_ip}")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(f"session:{mac}")
+        # Redis supprime de lui-même le set quand il devient vide
+        if client_ip:
+            pipe.srem(f"ip_sessions:{client_ip}", mac)
+        await pipe.execute()
 
-    # Mode dev : on skip la révocation réseau réelle
-    if settings.dev_mode:
-        logger.info(f"[DEV MODE] Révocation simulée pour {mac} / {client_ip}")
-        return True
+    if client_ip:
+        arp_cache.pop(client_ip)
 
-    if settings.auth_method == "nftables":
-        return await revoke_mac_nftables(mac)
-    elif settings.auth_method == "pfsense":
-        if client_ip:
-            return await revoke_ip_pfsense(client_ip)
-        logger.warning("Révocation pfSense sans IP - ignorée")
-        return True
-    # CoA disconnect serait ici pour RADIUS
-    return True
+    return await REVOKE_FN(mac, client_ip)
 
 
 # ============================================
@@ -330,25 +579,23 @@ async def revoke_mac(mac: str, client_ip: str = None) -> bool:
 async def index(request: Request):
     """Page d'accueil du portail captif."""
     client_ip = get_client_ip(request)
-    mac = get_mac_from_ip(client_ip)
+    mac = await get_mac_from_ip(client_ip)
     
     # Vérifier si déjà autorisé
     if mac:
-        session_data = await redis_client.get(f"session:{mac}")
-        if session_data:
+        username = (await get_session_fields(mac, "username"))[0]
+        if username:
             return templates.TemplateResponse("already_connected.html", {
                 "request": request,
-                "username": session_data.split(":")[0],
-                "theme": theme,
-                "css_variables": get_css_variables()
+                "username": username,
+                **TEMPLATE_CONTEXT_DEFAULTS
             })
     
     return templates.TemplateResponse("login.html", {
         "request": request,
         "client_ip": client_ip,
         "mac": mac or "Non détectée",
-        "theme": theme,
-        "css_variables": get_css_variables()
+        **TEMPLATE_CONTEXT_DEFAULTS
     })
 
 
@@ -356,7 +603,7 @@ async def index(request: Request):
 async def login(request: Request):
     """Initie le flow OIDC vers Keycloak."""
     client_ip = get_client_ip(request)
-    mac = get_mac_from_ip(client_ip)
+    mac = await get_mac_from_ip(client_ip)
     
     if not mac:
         raise HTTPException(
@@ -409,7 +656,7 @@ async def callback(request: Request):
             "email": email,
             "mac": mac,
             "ip": client_ip,
-            "login_time": datetime.utcnow().isoformat()
+            "login_time": int(time.time())
         }
         
         logger.info(f"Login réussi: {username} ({mac})")
@@ -434,8 +681,7 @@ async def success(request: Request):
         "username": user["username"],
         "redirect_url": settings.success_redirect_url,
         "session_timeout": settings.session_timeout // 3600,  # En heures
-        "theme": theme,
-        "css_variables": get_css_variables()
+        **TEMPLATE_CONTEXT_DEFAULTS
     })
 
 
@@ -456,20 +702,19 @@ async def logout(request: Request):
 async def status(request: Request):
     """Vérifie le statut de connexion (API)."""
     client_ip = get_client_ip(request)
-    mac = get_mac_from_ip(client_ip)
+    mac = await get_mac_from_ip(client_ip)
     
     if not mac:
         return {"connected": False, "reason": "MAC non détectée"}
     
-    session_data = await redis_client.get(f"session:{mac}")
+    username, since = await get_session_fields(mac, "username", "since")
     
-    if session_data:
-        parts = session_data.split(":")
+    if username:
         return {
             "connected": True,
-            "username": parts[0],
+            "username": username,
             "mac": mac,
-            "since": parts[1] if len(parts) > 1 else None
+            "since": datetime.fromtimestamp(int(since), tz=timezone.utc).isoformat() if since else None
         }
     
     return {"connected": False, "mac": mac}
@@ -491,5 +736,9 @@ if __name__ == "__main__":
         "app.main:app",
         host=settings.app_host,
         port=settings.app_port,
-        reload=settings.debug
+        reload=settings.debug,
+        loop="uvloop",
+        http="httptools",
+        # reload et workers sont exclusifs
+        workers=None if settings.debug else os.cpu_count()
     )
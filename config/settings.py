@@ -17,6 +17,9 @@ class Settings(BaseSettings):
     keycloak_client_id: str = "captive-portal"
     keycloak_client_secret: str = "your-client-secret"
     
+    # Durée de cache des métadonnées OIDC et JWKS dans Redis (secondes)
+    oidc_cache_ttl: int = 600
+    
     # URLs dérivées (calculées)
     @property
     def keycloak_issuer(self) -> str:
@@ -32,6 +35,8 @@ class Settings(BaseSettings):
     
     # Redis (pour sessions et MAC autorisées)
     redis_url: str = "redis://localhost:6379/0"
+    redis_max_connections: int = 200
+    redis_health_check_interval: int = 30  # secondes
     
     # Session timeout (secondes)
     session_timeout: int = 28800  # 8 heures par défaut
@@ -43,11 +48,14 @@ class Settings(BaseSettings):
     nft_table: str = "inet"
     nft_chain: str = "filter"
     nft_set: str = "allowed_macs"
+    nft_batch_window_ms: int = 50  # Fenêtre de regroupement des ajouts
+    nft_batch_max: int = 256
     
     # RADIUS CoA config
     radius_nas_ip: str = "10.0.0.1"
     radius_secret: str = "radius-secret"
     radius_coa_port: int = 3799
+    radius_dictionary: str = "/etc/freeradius/3.0/dictionary"
 
     # pfSense API config (si AUTH_METHOD=pfsense)
     pfsense_host: str = "https://192.168.1.1"
@@ -58,6 +66,19 @@ class Settings(BaseSettings):
     
     # Interface réseau pour ARP lookup
     network_interface: str = "eth0"
+
+    # Cache des résolutions IP -> MAC (secondes / nombre d'entrées)
+    arp_cache_ttl: int = 60
+    arp_cache_size: int = 4096
+    arp_refresh_interval: int = 5  # Dump complet de la table ARP (0 = désactivé)
+    
+    # Durée de cache navigateur des fichiers /static (secondes)
+    static_max_age: int = 31536000
+    
+    # Cache du bytecode Jinja2 (partagé entre workers). Par défaut, répertoire
+    # privé à l'utilisateur (0700, propriétaire vérifié) choisi par Jinja2 ;
+    # un chemin explicite doit appartenir à l'utilisateur du service
+    jinja_cache_dir: Optional[str] = None
     
     # Callback URL (doit être accessible depuis le client)
     callback_url: str = "http://portal.example.com/callback"
@@ -68,6 +89,11 @@ class Settings(BaseSettings):
     # Keycloak Admin (pour sync sessions)
     keycloak_admin_client_id: str = "admin-cli"
     keycloak_admin_client_secret: str = "admin-secret"
+    # Âge (secondes) au-delà duquel la liste des sessions Keycloak est rafraîchie en arrière-plan
+    keycloak_sessions_stale_after: int = 30
+    # Âge maximal (secondes) de cette liste : au-delà, relecture synchrone et
+    # le cycle échoue si Keycloak ne répond pas (doit dépasser l'intervalle du daemon)
+    keycloak_sessions_max_age: int = 900
     
     class Config:
         env_file = ".env"
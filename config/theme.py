@@ -2,6 +2,8 @@
 # Configuration visuelle du portail captif
 # Modifier ces valeurs pour personnaliser l'apparence
 
+from functools import lru_cache
+
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -75,8 +77,9 @@ class ThemeSettings(BaseSettings):
 theme = ThemeSettings()
 
 
+@lru_cache(maxsize=1)
 def get_css_variables() -> str:
-    """Génère les variables CSS depuis la config."""
+    """Génère les variables CSS depuis la config (calculées une seule fois)."""
     return f"""
     :root {{
         --primary-color: {theme.primary_color};
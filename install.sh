@@ -40,7 +40,7 @@ cd $INSTALL_DIR
 $PYTHON_VERSION -m venv venv
 source venv/bin/activate
 pip install --upgrade pip
-pip install -r requirements.txt
+pip install -e .
 
 # Configuration
 echo "[4/7] Configuration..."
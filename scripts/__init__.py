@@ -0,0 +1 @@
+# scripts/__init__.py
@@ -0,0 +1,207 @@
+# scripts/neighbors.py
+"""
+Accès à la table des voisins (ARP/NDP) du noyau via netlink.
+
+Remplace l'appel à `ip neigh show <ip>` : une seule socket NETLINK_ROUTE
+ouverte au démarrage, une requête RTM_GETNEIGH par lookup (ou un dump
+complet de la table), sans fork/exec ni parsing de texte.
+"""
+
+import asyncio
+import errno
+import logging
+import os
+import socket
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Constantes netlink (linux/netlink.h, linux/rtnetlink.h, linux/neighbour.h)
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_MULTI = 0x02
+NLM_F_DUMP = 0x300
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+
+# nlmsghdr: len, type, flags, seq, pid
+_NLMSGHDR = struct.Struct("=IHHII")
+# ndmsg: family, pad1, pad2, ifindex, state, flags, type
+_NDMSG = struct.Struct("=BBHiHBB")
+# rtattr: len, type
+_RTATTR = struct.Struct("=HH")
+_ERRNO = struct.Struct("=i")
+
+_MAC_FORMAT = "%02X:%02X:%02X:%02X:%02X:%02X"
+
+
+class NeighborTable:
+    """Client netlink pour interroger la table des voisins d'une interface."""
+
+    def __init__(self, interface: str, timeout: float = 1.0):
+        """
+        Ouvre la socket netlink.
+
+        Args:
+            interface: Interface réseau côté clients (ex: eth0)
+            timeout: Timeout d'une requête en secondes
+        """
+        self.interface = interface
+        self.timeout = timeout
+        self.ifindex = socket.if_nametoindex(interface)
+        self._sock = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,
+            NETLINK_ROUTE
+        )
+        self._sock.bind((0, 0))
+        self._seq = 0
+        # Une seule requête en vol à la fois sur la socket partagée
+        self._lock = asyncio.Lock()
+
+    def _next_seq(self) -> int:
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        return self._seq
+
+    async def lookup(self, ip: str) -> Optional[str]:
+        """Retourne la MAC (format AA:BB:CC:DD:EE:FF) associée à une IP, ou None."""
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        dst = socket.inet_pton(family, ip)
+
+        seq = self._next_seq()
+        body = (
+            _NDMSG.pack(family, 0, 0, self.ifindex, 0, 0, 0)
+            + _RTATTR.pack(_RTATTR.size + len(dst), NDA_DST) + dst
+        )
+        msg = _NLMSGHDR.pack(
+            _NLMSGHDR.size + len(body), RTM_GETNEIGH, NLM_F_REQUEST, seq, 0
+        ) + body
+
+        async with self._lock:
+            replies = await asyncio.wait_for(self._exchange(msg, seq), self.timeout)
+
+        for msg_type, data, offset, length in replies:
+            if msg_type == RTM_NEWNEIGH:
+                return self._parse_neigh(data, offset, length)[2]
+        return None
+
+    async def dump(self) -> Dict[str, str]:
+        """Retourne toute la table des voisins de l'interface: {ip: mac}."""
+        seq = self._next_seq()
+        body = _NDMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0)
+        msg = _NLMSGHDR.pack(
+            _NLMSGHDR.size + len(body), RTM_GETNEIGH, NLM_F_REQUEST | NLM_F_DUMP, seq, 0
+        ) + body
+
+        async with self._lock:
+            replies = await asyncio.wait_for(self._exchange(msg, seq), self.timeout)
+
+        table = {}
+        for msg_type, data, offset, length in replies:
+            if msg_type != RTM_NEWNEIGH:
+                continue
+            ifindex, ip, mac = self._parse_neigh(data, offset, length)
+            if ifindex == self.ifindex and ip and mac:
+                table[ip] = mac
+        return table
+
+    async def _exchange(self, msg: bytes, seq: int) -> List[Tuple[int, bytes, int, int]]:
+        """Envoie une requête et collecte les messages de réponse correspondants."""
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self._sock, msg)
+
+        replies = []
+        while True:
+            data = await loop.sock_recv(self._sock, 65536)
+            offset = 0
+            while offset + _NLMSGHDR.size <= len(data):
+                length, msg_type, flags, msg_seq, _ = _NLMSGHDR.unpack_from(data, offset)
+                if length < _NLMSGHDR.size:
+                    break
+                # Ignorer les réponses tardives d'une requête précédente (timeout)
+                if msg_seq == seq:
+                    if msg_type == NLMSG_DONE:
+                        return replies
+                    if msg_type == NLMSG_ERROR:
+                        err = -_ERRNO.unpack_from(data, offset + _NLMSGHDR.size)[0]
+                        if err in (0, errno.ENOENT):
+                            return replies
+                        raise OSError(err, os.strerror(err))
+                    replies.append((msg_type, data, offset, length))
+                    if not flags & NLM_F_MULTI:
+                        return replies
+                offset += (length + 3) & ~3
+
+    @staticmethod
+    def _parse_neigh(
+        data: bytes,
+        offset: int,
+        length: int
+    ) -> Tuple[int, Optional[str], Optional[str]]:
+        """Extrait (ifindex, NDA_DST, NDA_LLADDR) d'un message RTM_NEWNEIGH."""
+        family, _, _, ifindex, state, _, _ = _NDMSG.unpack_from(data, offset + _NLMSGHDR.size)
+
+        ip = None
+        mac = None
+        end = offset + length
+        attr = offset + _NLMSGHDR.size + _NDMSG.size
+        while attr + _RTATTR.size <= end:
+            attr_len, attr_type = _RTATTR.unpack_from(data, attr)
+            if attr_len < _RTATTR.size:
+                break
+            value = data[attr + _RTATTR.size:attr + attr_len]
+            if attr_type == NDA_DST and family in (socket.AF_INET, socket.AF_INET6):
+                ip = socket.inet_ntop(family, value)
+            elif attr_type == NDA_LLADDR and len(value) == 6:
+                mac = _MAC_FORMAT % tuple(value)
+            attr += (attr_len + 3) & ~3
+
+        if state & (NUD_INCOMPLETE | NUD_FAILED):
+            mac = None
+        return ifindex, ip, mac
+
+    def close(self):
+        """Ferme la socket netlink."""
+        self._sock.close()
+
+
+class ArpCache:
+    """Cache LRU à durée de vie limitée pour les résolutions IP -> MAC."""
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def get(self, ip: str) -> Optional[str]:
+        """Retourne la MAC en cache pour une IP si elle n'a pas expiré."""
+        entry = self._entries.get(ip)
+        if entry is None:
+            return None
+        mac, expires = entry
+        if expires < time.monotonic():
+            del self._entries[ip]
+            return None
+        self._entries.move_to_end(ip)
+        return mac
+
+    def set(self, ip: str, mac: str):
+        """Mémorise une résolution IP -> MAC."""
+        self._entries[ip] = (mac, time.monotonic() + self.ttl)
+        self._entries.move_to_end(ip)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, ip: str) -> Optional[str]:
+        """Invalide l'entrée d'une IP."""
+        entry = self._entries.pop(ip, None)
+        return entry[0] if entry else None
@@ -0,0 +1,239 @@
+# scripts/nft.py
+"""
+Exécution asynchrone des commandes nftables.
+
+Utilisé par le portail et le daemon de synchronisation : `nft` est lancé via
+asyncio.create_subprocess_exec pour ne pas bloquer la boucle d'événements
+pendant le fork/exec.
+
+Si le binding Python de libnftables (paquet système python3-nftables) est
+disponible, les opérations sur les éléments d'un set passent par son API
+JSON, dans le processus, sans fork/exec.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import nftables
+except ImportError:
+    nftables = None
+
+logger = logging.getLogger(__name__)
+
+# Instance libnftables partagée (non thread-safe : accès sous verrou)
+_nft_lib = None
+_nft_lib_unavailable = nftables is None
+_nft_lib_lock = threading.Lock()
+
+
+async def run_nft(
+    *args: str,
+    stdin: Optional[str] = None,
+    timeout: float = 10
+) -> Tuple[int, str]:
+    """
+    Lance `nft` avec les arguments donnés.
+
+    Args:
+        args: Arguments passés à nft (ex: "add", "element", ...)
+        stdin: Script envoyé sur l'entrée standard (pour `nft -f -`)
+        timeout: Timeout en secondes
+
+    Returns:
+        (code de retour, stderr)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "nft", *args,
+        stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(
+            proc.communicate(stdin.encode() if stdin is not None else None),
+            timeout
+        )
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stderr.decode(errors="replace").strip()
+
+
+def format_elements(
+    verb: str,
+    table: str,
+    chain: str,
+    set_name: str,
+    elements: List[str]
+) -> str:
+    """Construit une ligne de script nft `<verb> element ... { e1, e2, ... }`."""
+    return f"{verb} element {table} {chain} {set_name} {{ {', '.join(elements)} }}\n"
+
+
+def _get_nft_lib():
+    """Retourne l'instance libnftables, ou None si le binding est indisponible."""
+    global _nft_lib, _nft_lib_unavailable
+    if _nft_lib is None and not _nft_lib_unavailable:
+        try:
+            _nft_lib = nftables.Nftables()
+            _nft_lib.set_json_output(True)
+        except Exception as e:
+            # Binding présent mais libnftables.so introuvable : repli sur `nft`
+            logger.warning(f"libnftables indisponible, utilisation de `nft`: {e}")
+            _nft_lib_unavailable = True
+    return _nft_lib
+
+
+def _json_cmd(cmd: dict) -> Tuple[int, str]:
+    """Exécute une commande JSON libnftables (appel bloquant)."""
+    with _nft_lib_lock:
+        returncode, _, error = _nft_lib.json_cmd(cmd)
+    return returncode, (error or "").strip()
+
+
+async def _run_elements(
+    verb: str,
+    table: str,
+    chain: str,
+    set_name: str,
+    elements: List[str],
+    timeout: float
+) -> Tuple[int, str]:
+    """Applique une transaction sur les éléments d'un set (libnftables ou `nft -f -`)."""
+    if _get_nft_lib() is not None:
+        # table/chain correspondent à la famille et à la table nft (ex: inet filter)
+        cmd = {"nftables": [{verb: {"element": {
+            "family": table,
+            "table": chain,
+            "name": set_name,
+            "elem": elements
+        }}}]}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _json_cmd, cmd)
+
+    script = format_elements(verb, table, chain, set_name, elements)
+    return await run_nft("-f", "-", stdin=script, timeout=timeout)
+
+
+async def apply_elements(
+    verb: str,
+    table: str,
+    chain: str,
+    set_name: str,
+    elements: List[str],
+    timeout: float = 10
+) -> Dict[str, bool]:
+    """
+    Ajoute/retire plusieurs éléments d'un set en une seule transaction
+    (libnftables si disponible, sinon `nft -f -`).
+
+    La transaction nft est atomique : si elle échoue (ex: un élément invalide),
+    chaque élément est rejoué individuellement pour isoler le fautif.
+
+    Returns:
+        Résultat par élément
+    """
+    elements = list(dict.fromkeys(elements))
+    if not elements:
+        return {}
+
+    returncode, stderr = await _run_elements(verb, table, chain, set_name, elements, timeout)
+    if returncode == 0:
+        return dict.fromkeys(elements, True)
+
+    logger.error(f"Erreur nftables ({verb}, {len(elements)} éléments): {stderr}")
+    if len(elements) == 1:
+        return {elements[0]: False}
+
+    results = {}
+    for element in elements:
+        returncode, stderr = await _run_elements(verb, table, chain, set_name, [element], timeout)
+        if returncode != 0:
+            logger.error(f"Erreur nftables ({verb} {element}): {stderr}")
+        results[element] = returncode == 0
+    return results
+
+
+class NftBatcher:
+    """Regroupe les ajouts dans un set nftables sur une courte fenêtre."""
+
+    def __init__(
+        self,
+        table: str,
+        chain: str,
+        set_name: str,
+        window: float = 0.05,
+        max_batch: int = 256,
+        timeout: float = 10
+    ):
+        """
+        Args:
+            table, chain, set_name: Cible nft (ex: inet filter allowed_macs)
+            window: Fenêtre d'accumulation en secondes
+            max_batch: Nombre maximum d'éléments par transaction
+            timeout: Timeout d'une invocation nft en secondes
+        """
+        self.table = table
+        self.chain = chain
+        self.set_name = set_name
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Démarre la tâche de fond (à appeler depuis la boucle asyncio)."""
+        if not self._task:
+            self._task = asyncio.create_task(self._worker())
+
+    async def add(self, element: str) -> bool:
+        """Met un élément en file et attend le résultat de sa transaction."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((element, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Laisser les autorisations concurrentes s'accumuler
+            await asyncio.sleep(self.window)
+            stop = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            results = await apply_elements(
+                "add", self.table, self.chain, self.set_name,
+                [element for element, _ in batch],
+                timeout=self.timeout
+            )
+        except Exception as e:
+            logger.error(f"Exception batch nftables: {e}")
+            results = {}
+
+        for element, future in batch:
+            if not future.done():
+                future.set_result(results.get(element, False))
+
+    async def close(self):
+        """Traite les éléments encore en file puis arrête la tâche de fond."""
+        if self._task:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
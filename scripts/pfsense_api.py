@@ -10,9 +10,11 @@ Compatibilité:
 Documentation: https://github.com/jaredhendrickson13/pfsense-api
 """
 
+import asyncio
 import httpx
 import logging
-from typing import Optional
+import orjson
+from typing import Dict, List, Optional
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -27,7 +29,11 @@ class PfSenseAPI:
         api_key: str,
         api_secret: str,
         verify_ssl: bool = False,
-        timeout: int = 10
+        timeout: float = 5.0,
+        connect_timeout: float = 2.0,
+        client: Optional[httpx.AsyncClient] = None,
+        batch_max: int = 64,
+        batch_window_ms: int = 100
     ):
         """
         Initialise le client pfSense API.
@@ -37,21 +43,35 @@ class PfSenseAPI:
             api_key: Clé API pfSense
             api_secret: Secret API pfSense
             verify_ssl: Vérifier le certificat SSL (False pour self-signed)
-            timeout: Timeout des requêtes en secondes
+            timeout: Timeout des requêtes en secondes (court : appelé pendant le login)
+            connect_timeout: Timeout d'établissement de connexion en secondes
+            client: Client HTTP externe (sinon un client keep-alive est créé
+                au premier appel et fermé par aclose())
+            batch_max: Nombre maximum d'opérations regroupées par lot
+            batch_window_ms: Fenêtre de regroupement des opérations en ms
         """
         self.host = host.rstrip('/')
         self.api_key = api_key
         self.api_secret = api_secret
         self.verify_ssl = verify_ssl
         self.timeout = timeout
+        self.connect_timeout = connect_timeout
         self.base_url = f"{self.host}/api/v1"
-
-    def _get_headers(self) -> dict:
-        """Retourne les headers d'authentification."""
-        return {
+        # Headers invariants, construits une fois pour toutes
+        self._headers = {
             "Authorization": f"{self.api_key} {self.api_secret}",
             "Content-Type": "application/json"
         }
+        self._client = client
+        self._owns_client = client is None
+        self.batch_max = batch_max
+        self.batch_window_ms = batch_window_ms
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def _get_headers(self) -> dict:
+        """Retourne les headers d'authentification."""
+        return self._headers
 
     async def _request(
         self,
@@ -62,28 +82,87 @@ class PfSenseAPI:
         """Effectue une requête à l'API pfSense."""
         url = f"{self.base_url}/{endpoint}"
 
-        async with httpx.AsyncClient(verify=self.verify_ssl, timeout=self.timeout) as client:
-            try:
-                response = await client.request(
-                    method=method,
-                    url=url,
-                    headers=self._get_headers(),
-                    json=data
-                )
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPStatusError as e:
-                logger.error(f"pfSense API error: {e.response.status_code} - {e.response.text}")
-                raise
-            except Exception as e:
-                logger.error(f"pfSense API request failed: {e}")
-                raise
+        try:
+            response = await self._get_client().request(
+                method=method,
+                url=url,
+                # Le client créé ici porte déjà les headers par défaut
+                headers=None if self._owns_client else self._headers,
+                # orjson : encode directement en bytes (Content-Type dans les headers)
+                content=orjson.dumps(data) if data is not None else None
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except httpx.HTTPStatusError as e:
+            logger.error(f"pfSense API error: {e.response.status_code} - {e.response.text}")
+            raise
+        except Exception as e:
+            logger.error(f"pfSense API request failed: {e}")
+            raise
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Retourne le client HTTP persistant (créé au premier appel, dans la boucle)."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                verify=self.verify_ssl,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                headers=self._headers,
+                limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+                http2=True
+            )
+        return self._client
+
+    async def aclose(self):
+        """Traite les opérations en file puis ferme le client HTTP s'il a été créé par cette instance."""
+        if self._worker is not None:
+            await self._queue.put(None)
+            await self._worker
+            self._worker = None
+        if self._client is not None and self._owns_client:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self) -> "PfSenseAPI":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
 
     async def get_firewall_aliases(self) -> list:
         """Liste tous les alias firewall."""
         result = await self._request("GET", "firewall/alias")
         return result.get("data", [])
 
+    async def _get_aliases_by_name(self) -> Dict[str, dict]:
+        """
+        Récupère les alias (un seul GET) indexés par nom.
+
+        Pas de cache entre deux requêtes : un PUT remplace l'alias entier et
+        plusieurs workers du portail modifient le même alias, l'état doit donc
+        être relu juste avant chaque écriture.
+        """
+        aliases = await self.get_firewall_aliases()
+        return {alias.get("name"): alias for alias in aliases}
+
+    @staticmethod
+    def _parse_alias(alias: dict) -> dict:
+        """Découpe les champs address/detail d'un alias pfSense en listes."""
+        current_addresses = alias.get("address", "")
+        current_details = alias.get("detail", "")
+
+        if isinstance(current_addresses, str):
+            addresses = [a.strip() for a in current_addresses.split(" ") if a.strip()]
+        else:
+            addresses = list(current_addresses) if current_addresses else []
+
+        if isinstance(current_details, str):
+            details = [d.strip() for d in current_details.split("||") if d.strip()]
+        else:
+            details = list(current_details) if current_details else []
+
+        return {"addresses": addresses, "details": details, "addr_set": set(addresses)}
+
     async def create_alias_if_not_exists(self, alias_name: str = "captive_portal_allowed") -> bool:
         """
         Crée l'alias pour les MAC autorisées s'il n'existe pas.
@@ -93,13 +172,10 @@ class PfSenseAPI:
         on utilise donc les IP avec des baux DHCP statiques ou on track par IP.
         """
         try:
-            aliases = await self.get_firewall_aliases()
-
-            # Vérifier si l'alias existe déjà
-            for alias in aliases:
-                if alias.get("name") == alias_name:
-                    logger.info(f"Alias '{alias_name}' existe déjà")
-                    return True
+            # Vérifier si l'alias existe déjà (index par nom, pas de parcours)
+            if alias_name in await self._get_aliases_by_name():
+                logger.info(f"Alias '{alias_name}' existe déjà")
+                return True
 
             # Créer l'alias
             data = {
@@ -130,67 +206,14 @@ class PfSenseAPI:
         """
         Ajoute une IP à l'alias des clients autorisés.
 
+        Les ajouts concurrents sont regroupés en un seul PUT + apply.
+
         Args:
             ip: Adresse IP du client
             username: Nom d'utilisateur (pour la description)
             alias_name: Nom de l'alias pfSense
         """
-        try:
-            # Récupérer l'alias actuel
-            aliases = await self.get_firewall_aliases()
-            target_alias = None
-
-            for alias in aliases:
-                if alias.get("name") == alias_name:
-                    target_alias = alias
-                    break
-
-            if not target_alias:
-                logger.error(f"Alias '{alias_name}' non trouvé")
-                return False
-
-            # Récupérer les adresses existantes
-            current_addresses = target_alias.get("address", "")
-            current_details = target_alias.get("detail", "")
-
-            # Convertir en listes
-            if isinstance(current_addresses, str):
-                addresses = [a.strip() for a in current_addresses.split(" ") if a.strip()]
-            else:
-                addresses = list(current_addresses) if current_addresses else []
-
-            if isinstance(current_details, str):
-                details = [d.strip() for d in current_details.split("||") if d.strip()]
-            else:
-                details = list(current_details) if current_details else []
-
-            # Vérifier si l'IP existe déjà
-            if ip in addresses:
-                logger.info(f"IP {ip} déjà dans l'alias")
-                return True
-
-            # Ajouter la nouvelle IP
-            addresses.append(ip)
-            details.append(f"{username}@{datetime.now().strftime('%Y-%m-%d %H:%M')}")
-
-            # Mettre à jour l'alias
-            data = {
-                "name": alias_name,
-                "type": "host",
-                "address": " ".join(addresses),
-                "detail": "||".join(details)
-            }
-
-            await self._request("PUT", f"firewall/alias", data)
-            logger.info(f"IP {ip} ajoutée à l'alias '{alias_name}' pour {username}")
-
-            # Appliquer les changements
-            await self.apply_changes()
-            return True
-
-        except Exception as e:
-            logger.error(f"Erreur ajout IP à l'alias: {e}")
-            return False
+        return await self._enqueue("add", ip, username, alias_name)
 
     async def remove_ip_from_alias(
         self,
@@ -200,67 +223,142 @@ class PfSenseAPI:
         """
         Retire une IP de l'alias des clients autorisés.
 
+        Les retraits concurrents sont regroupés en un seul PUT + apply.
+
         Args:
             ip: Adresse IP du client
             alias_name: Nom de l'alias pfSense
         """
-        try:
-            # Récupérer l'alias actuel
-            aliases = await self.get_firewall_aliases()
-            target_alias = None
+        return await self._enqueue("remove", ip, None, alias_name)
 
-            for alias in aliases:
-                if alias.get("name") == alias_name:
-                    target_alias = alias
+    async def _enqueue(
+        self,
+        action: str,
+        ip: str,
+        username: Optional[str],
+        alias_name: str
+    ) -> bool:
+        """Met une opération en file et attend le résultat de son lot."""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run_batches())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((action, ip, username, alias_name, future))
+        return await future
+
+    async def _run_batches(self):
+        """Tâche de fond : draine la file par lots (batch_max ou batch_window_ms)."""
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Laisser les opérations concurrentes s'accumuler
+            await asyncio.sleep(self.batch_window_ms / 1000)
+            stop = False
+            while len(batch) < self.batch_max and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
                     break
+                batch.append(item)
+            await self._process_batch(batch)
+            if stop:
+                return
+
+    async def _process_batch(self, batch: List[tuple]):
+        """Applique un lot : un GET, un PUT par alias modifié, puis un seul apply."""
+        # Grouper par alias en conservant l'ordre des opérations
+        by_alias: Dict[str, List[tuple]] = {}
+        for op in batch:
+            by_alias.setdefault(op[3], []).append(op)
+
+        results = []
+        changed_any = False
+        try:
+            # Relire l'état courant juste avant les PUT
+            aliases = await self._get_aliases_by_name()
+        except Exception as e:
+            logger.error(f"Erreur lecture des alias: {e}")
+            aliases = None
 
-            if not target_alias:
-                logger.error(f"Alias '{alias_name}' non trouvé")
-                return False
-
-            # Récupérer les adresses existantes
-            current_addresses = target_alias.get("address", "")
-            current_details = target_alias.get("detail", "")
-
-            # Convertir en listes
-            if isinstance(current_addresses, str):
-                addresses = [a.strip() for a in current_addresses.split(" ") if a.strip()]
-            else:
-                addresses = list(current_addresses) if current_addresses else []
-
-            if isinstance(current_details, str):
-                details = [d.strip() for d in current_details.split("||") if d.strip()]
+        for alias_name, ops in by_alias.items():
+            if aliases is None:
+                success = False
             else:
-                details = list(current_details) if current_details else []
-
-            # Retirer l'IP
-            if ip not in addresses:
-                logger.info(f"IP {ip} non trouvée dans l'alias")
-                return True
+                try:
+                    changed = await self._update_alias(aliases.get(alias_name), alias_name, ops)
+                    changed_any = changed_any or changed
+                    success = True
+                except Exception as e:
+                    logger.error(f"Erreur mise à jour de l'alias '{alias_name}': {e}")
+                    success = False
+            results.extend((op[4], success) for op in ops)
+
+        # Appliquer les changements
+        if changed_any:
+            await self.apply_changes()
 
-            idx = addresses.index(ip)
-            addresses.pop(idx)
-            if idx < len(details):
-                details.pop(idx)
+        for future, success in results:
+            if not future.done():
+                future.set_result(success)
 
-            # Mettre à jour l'alias
-            data = {
-                "name": alias_name,
-                "type": "host",
-                "address": " ".join(addresses) if addresses else "",
-                "detail": "||".join(details) if details else ""
-            }
+    async def _update_alias(
+        self,
+        alias: Optional[dict],
+        alias_name: str,
+        ops: List[tuple]
+    ) -> bool:
+        """
+        Fusionne les ajouts/retraits dans l'alias et envoie un seul PUT.
 
-            await self._request("PUT", f"firewall/alias", data)
-            logger.info(f"IP {ip} retirée de l'alias '{alias_name}'")
+        Returns:
+            True si l'alias a été modifié
+        """
+        if not alias:
+            raise ValueError(f"Alias '{alias_name}' non trouvé")
+
+        # Adresses découpées une seule fois pour tout le lot
+        entry = self._parse_alias(alias)
+        addresses = entry["addresses"]
+        details = entry["details"]
+        addr_set = entry["addr_set"]
+
+        changed = False
+        for action, ip, username, _, _ in ops:
+            if action == "add":
+                # Vérifier si l'IP existe déjà
+                if ip in addr_set:
+                    logger.info(f"IP {ip} déjà dans l'alias")
+                    continue
+                addr_set.add(ip)
+                addresses.append(ip)
+                details.append(f"{username}@{datetime.now().strftime('%Y-%m-%d %H:%M')}")
+                logger.info(f"IP {ip} ajoutée à l'alias '{alias_name}' pour {username}")
+            else:
+                if ip not in addr_set:
+                    logger.info(f"IP {ip} non trouvée dans l'alias")
+                    continue
+                addr_set.discard(ip)
+                idx = addresses.index(ip)
+                addresses.pop(idx)
+                if idx < len(details):
+                    details.pop(idx)
+                logger.info(f"IP {ip} retirée de l'alias '{alias_name}'")
+            changed = True
+
+        if not changed:
+            return False
 
-            # Appliquer les changements
-            await self.apply_changes()
-            return True
+        # Mettre à jour l'alias (sérialisation au format pfSense une seule fois)
+        data = {
+            "name": alias_name,
+            "type": "host",
+            "address": " ".join(addresses),
+            "detail": "||".join(details)
+        }
 
-        except Exception as e:
-            logger.error(f"Erreur retrait IP de l'alias: {e}")
-            return False
+        await self._request("PUT", "firewall/alias", data)
+        return True
 
     async def apply_changes(self) -> bool:
         """Applique les changements de configuration pfSense."""
@@ -14,6 +14,7 @@ import argparse
 import socket
 import struct
 import hashlib
+import hmac
 import secrets
 import logging
 from typing import Optional
@@ -36,6 +37,13 @@ CALLING_STATION_ID = 31
 ACCT_SESSION_ID = 44
 MESSAGE_AUTHENTICATOR = 80
 
+# Formats précompilés : header (code, identifier, length) et attribut (type, length)
+_HDR = struct.Struct("!BBH")
+_ATTR = struct.Struct("!BB")
+
+# Calling-Station-Id au format AA-BB-CC-DD-EE-FF
+_COLON_TO_DASH = str.maketrans(":", "-")
+
 
 class RadiusPacket:
     """Constructeur de paquets RADIUS."""
@@ -45,7 +53,8 @@ class RadiusPacket:
         self.identifier = identifier or secrets.randbelow(256)
         self.secret = secret
         self.attributes = []
-        self.authenticator = secrets.token_bytes(16)
+        # Request Authenticator, calculé par build() (RFC 5176 §2.3)
+        self.authenticator = bytes(16)
     
     def add_attribute(self, attr_type: int, value: bytes):
         """Ajoute un attribut au paquet."""
@@ -57,41 +66,46 @@ class RadiusPacket:
     
     def add_ipaddr(self, attr_type: int, ip: str):
         """Ajoute un attribut IP."""
-        octets = [int(x) for x in ip.split('.')]
-        self.add_attribute(attr_type, bytes(octets))
+        self.add_attribute(attr_type, socket.inet_pton(socket.AF_INET, ip))
     
     def build(self) -> bytes:
         """Construit le paquet binaire."""
-        # Construire les attributs
-        attrs_data = b""
+        # Taille totale : header + attributs + Message-Authenticator (18 octets)
+        attrs_length = sum(len(value) + _ATTR.size for _, value in self.attributes) + 18
+        total_length = 20 + attrs_length
+
+        # Buffer préalloué, rempli en place (pas de reconstruction par slices)
+        buf = bytearray(total_length)
+        # Le champ Authenticator reste à zéro tant que les condensats ne sont pas calculés
+        _HDR.pack_into(buf, 0, self.code, self.identifier, total_length)
+
+        # Attributs
+        offset = 20
         for attr_type, value in self.attributes:
-            length = len(value) + 2
-            attrs_data += struct.pack("!BB", attr_type, length) + value
-        
-        # Placeholder pour Message-Authenticator (si nécessaire)
-        msg_auth_placeholder = struct.pack("!BB", MESSAGE_AUTHENTICATOR, 18) + (b"\x00" * 16)
-        attrs_data += msg_auth_placeholder
-        
-        # Header
-        total_length = 20 + len(attrs_data)
-        header = struct.pack("!BBH", self.code, self.identifier, total_length)
-        
-        # Paquet sans authenticator final
-        packet = header + self.authenticator + attrs_data
-        
-        # Calculer Message-Authenticator (HMAC-MD5)
-        msg_auth = hashlib.md5(packet + self.secret).digest()
-        
-        # Remplacer le placeholder
-        msg_auth_pos = len(header) + 16 + len(attrs_data) - 18
-        packet = packet[:msg_auth_pos + 2] + msg_auth + packet[msg_auth_pos + 18:]
-        
-        # Recalculer l'authenticator du paquet
-        packet_for_auth = packet[:4] + (b"\x00" * 16) + packet[20:]
-        final_auth = hashlib.md5(packet_for_auth + self.secret).digest()
-        packet = packet[:4] + final_auth + packet[20:]
-        
-        return packet
+            length = len(value) + _ATTR.size
+            _ATTR.pack_into(buf, offset, attr_type, length)
+            buf[offset + _ATTR.size:offset + length] = value
+            offset += length
+
+        # Placeholder pour Message-Authenticator (16 octets à zéro)
+        _ATTR.pack_into(buf, offset, MESSAGE_AUTHENTICATOR, 18)
+        msg_auth_pos = offset + _ATTR.size
+
+        # Hachage directement sur le buffer (memoryview), sans concaténation
+        view = memoryview(buf)
+
+        # Message-Authenticator = HMAC-MD5(secret, paquet), calculé avec
+        # l'authenticator à zéro pour un CoA/Disconnect-Request (RFC 5176 §3.5)
+        buf[msg_auth_pos:msg_auth_pos + 16] = hmac.new(self.secret, view, "md5").digest()
+
+        # Request Authenticator = MD5(paquet + secret), sans HMAC (RFC 5176 §2.3)
+        digest = hashlib.md5(view)
+        digest.update(self.secret)
+        self.authenticator = digest.digest()
+        buf[4:20] = self.authenticator
+        view.release()
+
+        return bytes(buf)
 
 
 class RadiusCoAClient:
@@ -102,22 +116,31 @@ class RadiusCoAClient:
         self.secret = secret.encode('utf-8')
         self.port = port
         self.timeout = timeout
+        # Socket UDP réutilisée pour tous les envois (sweep de déconnexions)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.settimeout(self.timeout)
+    
+    def close(self):
+        """Ferme la socket UDP."""
+        self._sock.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
     
     def send_packet(self, packet: RadiusPacket) -> Optional[int]:
         """Envoie un paquet et retourne le code de réponse."""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(self.timeout)
-            
             data = packet.build()
-            sock.sendto(data, (self.nas_ip, self.port))
+            self._sock.sendto(data, (self.nas_ip, self.port))
             
-            response, _ = sock.recvfrom(4096)
-            
-            if len(response) >= 1:
-                return response[0]  # Code de réponse
-            
-            return None
+            while True:
+                response, addr = self._sock.recvfrom(4096)
+                # Ignorer les réponses tardives d'un envoi précédent (timeout)
+                if len(response) >= 2 and response[1] == packet.identifier and addr[0] == self.nas_ip:
+                    return response[0]  # Code de réponse
             
         except socket.timeout:
             logger.error(f"Timeout CoA vers {self.nas_ip}:{self.port}")
@@ -125,8 +148,6 @@ class RadiusCoAClient:
         except Exception as e:
             logger.error(f"Erreur CoA: {e}")
             return None
-        finally:
-            sock.close()
     
     def authorize(self, mac: str, username: str, session_id: str = None) -> bool:
         """Envoie un CoA pour autoriser un utilisateur."""
@@ -134,7 +155,7 @@ class RadiusCoAClient:
         
         # Attributs
         packet.add_string(USER_NAME, username)
-        packet.add_string(CALLING_STATION_ID, mac.replace(":", "-"))
+        packet.add_string(CALLING_STATION_ID, mac.translate(_COLON_TO_DASH))
         
         if session_id:
             packet.add_string(ACCT_SESSION_ID, session_id)
@@ -159,7 +180,7 @@ class RadiusCoAClient:
         """Envoie un Disconnect-Request pour déconnecter un utilisateur."""
         packet = RadiusPacket(DISCONNECT_REQUEST, secret=self.secret)
         
-        packet.add_string(CALLING_STATION_ID, mac.replace(":", "-"))
+        packet.add_string(CALLING_STATION_ID, mac.translate(_COLON_TO_DASH))
         
         if username:
             packet.add_string(USER_NAME, username)
@@ -205,23 +226,22 @@ def main():
     
     args = parser.parse_args()
     
-    client = RadiusCoAClient(args.nas, args.secret, args.port)
-    
-    if args.action == "test":
-        success = client.test_connection()
-        exit(0 if success else 1)
-    
-    elif args.action == "authorize":
-        if not args.mac or not args.user:
-            parser.error("authorize nécessite --mac et --user")
-        success = client.authorize(args.mac, args.user, args.session)
-        exit(0 if success else 1)
-    
-    elif args.action == "disconnect":
-        if not args.mac:
-            parser.error("disconnect nécessite --mac")
-        success = client.disconnect(args.mac, args.user, args.session)
-        exit(0 if success else 1)
+    with RadiusCoAClient(args.nas, args.secret, args.port) as client:
+        if args.action == "test":
+            success = client.test_connection()
+            exit(0 if success else 1)
+        
+        elif args.action == "authorize":
+            if not args.mac or not args.user:
+                parser.error("authorize nécessite --mac et --user")
+            success = client.authorize(args.mac, args.user, args.session)
+            exit(0 if success else 1)
+        
+        elif args.action == "disconnect":
+            if not args.mac:
+                parser.error("disconnect nécessite --mac")
+            success = client.disconnect(args.mac, args.user, args.session)
+            exit(0 if success else 1)
 
 
 if __name__ == "__main__":
@@ -15,17 +15,17 @@ Usage:
 import asyncio
 import argparse
 import logging
-import subprocess
-import sys
-from datetime import datetime
-from typing import Optional
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 
 import httpx
+import orjson
 import redis.asyncio as redis
 
-# Ajouter le répertoire parent au path
-sys.path.insert(0, '/opt/captive-portal')
 from config.settings import settings
+from scripts.nft import apply_elements
 
 logging.basicConfig(
     level=logging.INFO,
@@ -33,26 +33,68 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Nombre maximum de révocations menées en parallèle
+REVOKE_CONCURRENCY = 32
+# Nombre maximum de MAC par transaction `nft -f -`
+NFT_DELETE_CHUNK = 1000
+# Préfixe des clés de session (client Redis sans decode_responses)
+SESSION_PREFIX = b"session:"
+
 
 class KeycloakAdmin:
     """Client pour l'API Admin Keycloak."""
     
-    def __init__(self):
+    def __init__(self, timeout: float = 10):
         self.base_url = settings.keycloak_url
         self.realm = settings.keycloak_realm
         self.client_id = settings.keycloak_admin_client_id
         self.client_secret = settings.keycloak_admin_client_secret
+        self.timeout = timeout
         self.token: Optional[str] = None
         self.token_expires: Optional[datetime] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._token_lock = asyncio.Lock()
+        # Cache stale-while-revalidate des sessions actives: (timestamp, sessions)
+        self.sessions_stale_after = settings.keycloak_sessions_stale_after
+        self.sessions_max_age = settings.keycloak_sessions_max_age
+        self._sessions_cache: Optional[Tuple[float, list]] = None
+        self._sessions_refresh: Optional[asyncio.Task] = None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Retourne le client HTTP persistant (créé au premier appel, dans la boucle)."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                verify=True,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_keepalive_connections=4),
+                # Une connexion TCP+TLS, requêtes concurrentes multiplexées
+                http2=True
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Arrête un éventuel rafraîchissement en cours et ferme le client HTTP."""
+        if self._sessions_refresh is not None:
+            self._sessions_refresh.cancel()
+            try:
+                await self._sessions_refresh
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._sessions_refresh = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
     
     async def get_token(self) -> str:
         """Obtient un token admin."""
-        if self.token and self.token_expires and datetime.utcnow() < self.token_expires:
-            return self.token
-        
-        async with httpx.AsyncClient(verify=True) as client:
-            response = await client.post(
-                f"{self.base_url}/realms/{self.realm}/protocol/openid-connect/token",
+        # Un seul renouvellement même si plusieurs requêtes concurrentes attendent
+        async with self._token_lock:
+            if self.token and self.token_expires and datetime.utcnow() < self.token_expires:
+                return self.token
+            
+            response = await self._get_client().post(
+                f"/realms/{self.realm}/protocol/openid-connect/token",
                 data={
                     "grant_type": "client_credentials",
                     "client_id": self.client_id,
@@ -60,85 +102,144 @@ class KeycloakAdmin:
                 }
             )
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             
             self.token = data["access_token"]
             # Expire 60s avant la vraie expiration
             expires_in = data.get("expires_in", 300) - 60
-            self.token_expires = datetime.utcnow()
+            self.token_expires = datetime.utcnow() + timedelta(seconds=expires_in)
             
             return self.token
     
     async def get_active_sessions(self) -> list:
-        """Récupère les sessions actives du realm."""
+        """Récupère les sessions actives du realm (éventuellement depuis le cache)."""
+        _, sessions = await self.get_active_sessions_snapshot()
+        return sessions
+    
+    async def get_active_sessions_snapshot(self, max_age: Optional[float] = None) -> Tuple[float, list]:
+        """
+        Retourne (timestamp, sessions) des sessions actives du realm.
+        
+        Stale-while-revalidate : au-delà de `sessions_stale_after` secondes,
+        la valeur en cache est retournée immédiatement et un rafraîchissement
+        est lancé en arrière-plan. Le premier appel, et tout appel dont le
+        cache dépasse `max_age` (ou `sessions_max_age` en cas de
+        rafraîchissements en échec), attendent Keycloak et propagent son erreur.
+        
+        Args:
+            max_age: Âge maximal accepté par l'appelant, en secondes
+        """
+        if self._sessions_cache is None:
+            return await self._refresh_sessions()
+        
+        fetched_at, _ = self._sessions_cache
+        age = time.time() - fetched_at
+        if age > self.sessions_max_age:
+            logger.warning(f"Sessions Keycloak en cache trop anciennes ({int(age)}s), relecture")
+            return await self._refresh_sessions()
+        if max_age is not None and age > max_age:
+            return await self._refresh_sessions()
+        if age > self.sessions_stale_after and (
+            self._sessions_refresh is None or self._sessions_refresh.done()
+        ):
+            self._sessions_refresh = asyncio.create_task(self._refresh_sessions_background())
+        return self._sessions_cache
+    
+    async def _refresh_sessions(self) -> Tuple[float, list]:
+        """Interroge Keycloak et remplace le cache d'un bloc."""
+        # Horodatage pris avant la requête : une session ouverte pendant
+        # l'appel peut manquer dans la liste
+        fetched_at = time.time()
+        sessions = await self._fetch_active_sessions()
+        self._sessions_cache = (fetched_at, sessions)
+        return self._sessions_cache
+    
+    async def _refresh_sessions_background(self):
+        try:
+            await self._refresh_sessions()
+        except Exception as e:
+            # Garder la valeur périmée plutôt que de la supprimer
+            logger.error(f"Erreur rafraîchissement sessions Keycloak: {e}")
+    
+    async def _fetch_active_sessions(self) -> list:
+        """Récupère les sessions actives du realm auprès de Keycloak."""
         token = await self.get_token()
+        client = self._get_client()
         
-        async with httpx.AsyncClient(verify=True) as client:
-            # Récupérer les sessions du client captive-portal
-            response = await client.get(
-                f"{self.base_url}/admin/realms/{self.realm}/clients",
-                headers={"Authorization": f"Bearer {token}"},
-                params={"clientId": settings.keycloak_client_id}
-            )
-            response.raise_for_status()
-            clients = response.json()
-            
-            if not clients:
-                return []
-            
-            client_uuid = clients[0]["id"]
-            
-            # Récupérer les sessions de ce client
-            response = await client.get(
-                f"{self.base_url}/admin/realms/{self.realm}/clients/{client_uuid}/user-sessions",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            response.raise_for_status()
-            
-            return response.json()
+        # Récupérer les sessions du client captive-portal
+        response = await client.get(
+            f"/admin/realms/{self.realm}/clients",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"clientId": settings.keycloak_client_id}
+        )
+        response.raise_for_status()
+        clients = orjson.loads(response.content)
+        
+        if not clients:
+            return []
+        
+        client_uuid = clients[0]["id"]
+        
+        # Récupérer les sessions de ce client
+        response = await client.get(
+            f"/admin/realms/{self.realm}/clients/{client_uuid}/user-sessions",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        response.raise_for_status()
+        
+        return orjson.loads(response.content)
     
     async def get_user_sessions(self, username: str) -> list:
         """Récupère les sessions d'un utilisateur."""
         token = await self.get_token()
+        client = self._get_client()
         
-        async with httpx.AsyncClient(verify=True) as client:
-            # Trouver l'utilisateur
-            response = await client.get(
-                f"{self.base_url}/admin/realms/{self.realm}/users",
-                headers={"Authorization": f"Bearer {token}"},
-                params={"username": username, "exact": "true"}
-            )
-            response.raise_for_status()
-            users = response.json()
-            
-            if not users:
-                return []
-            
-            user_id = users[0]["id"]
-            
-            # Récupérer ses sessions
-            response = await client.get(
-                f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}/sessions",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            response.raise_for_status()
-            
-            return response.json()
+        # Trouver l'utilisateur
+        response = await client.get(
+            f"/admin/realms/{self.realm}/users",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"username": username, "exact": "true"}
+        )
+        response.raise_for_status()
+        users = orjson.loads(response.content)
+        
+        if not users:
+            return []
+        
+        user_id = users[0]["id"]
+        
+        # Récupérer ses sessions
+        response = await client.get(
+            f"/admin/realms/{self.realm}/users/{user_id}/sessions",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        response.raise_for_status()
+        
+        return orjson.loads(response.content)
 
 
 class SessionSynchronizer:
     """Synchronise les sessions portail/Keycloak."""
     
-    def __init__(self):
+    def __init__(self, interval: Optional[int] = None):
+        """
+        Args:
+            interval: Intervalle du daemon en secondes. Une liste Keycloak plus
+                ancienne qu'un cycle est relue avant de décider des révocations
+                (sinon chaque cycle déciderait sur la liste du cycle précédent)
+        """
+        self.interval = interval
         self.redis_client: Optional[redis.Redis] = None
         self.keycloak = KeycloakAdmin()
     
     async def connect(self):
         """Connexion Redis."""
-        self.redis_client = redis.from_url(settings.redis_url, decode_responses=True)
+        # Réponses brutes (bytes) : seuls les champs utilisés sont décodés
+        self.redis_client = redis.from_url(settings.redis_url)
     
     async def close(self):
-        """Fermeture connexion."""
+        """Fermeture connexions."""
+        await self.keycloak.aclose()
         if self.redis_client:
             await self.redis_client.close()
     
@@ -151,48 +252,101 @@ class SessionSynchronizer:
             cursor, keys = await self.redis_client.scan(
                 cursor=cursor,
                 match="session:*",
-                count=100
+                count=1000
             )
             
+            # Un seul aller-retour Redis par page de SCAN
+            pipe = self.redis_client.pipeline(transaction=False)
             for key in keys:
-                mac = key.replace("session:", "")
-                data = await self.redis_client.get(key)
-                if data:
-                    parts = data.split(":")
+                pipe.hmget(key, "username", "since")
+            # Sans raise_on_error, une clé au mauvais type ne fait pas échouer la page
+            values = await pipe.execute(raise_on_error=False) if keys else []
+            
+            legacy_keys = []
+            for key, value in zip(keys, values):
+                if isinstance(value, redis.ResponseError):
+                    if not str(value).startswith("WRONGTYPE"):
+                        raise value
+                    legacy_keys.append(key)
+                    continue
+                username, since = value
+                if username:
+                    mac = key[len(SESSION_PREFIX):].decode()
                     sessions[mac] = {
-                        "username": parts[0],
-                        "login_time": parts[1] if len(parts) > 1 else None
+                        "username": username.decode(),
+                        "login_time": int(since) if since else 0
                     }
             
+            if legacy_keys:
+                sessions.update(await self._get_legacy_sessions(legacy_keys))
+            
             if cursor == 0:
                 break
         
         return sessions
     
-    async def revoke_mac_nftables(self, mac: str) -> bool:
-        """Révoque une MAC via nftables."""
-        try:
-            cmd = [
-                "nft", "delete", "element",
-                settings.nft_table, settings.nft_chain,
-                settings.nft_set, "{", mac, "}"
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-            return result.returncode == 0
-        except Exception as e:
-            logger.error(f"Erreur revoke nftables {mac}: {e}")
-            return False
+    async def _get_legacy_sessions(self, keys: List[bytes]) -> dict:
+        """
+        Lit les sessions écrites avant le passage en hash ("username:date:ip").
+        
+        Elles restent contrôlées face à Keycloak comme les autres (login_time à 0),
+        et révoquées normalement si l'utilisateur n'a plus de session.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        values = await pipe.execute(raise_on_error=False)
+        
+        sessions = {}
+        for key, raw in zip(keys, values):
+            mac = key[len(SESSION_PREFIX):].decode()
+            if not isinstance(raw, bytes) or not raw:
+                logger.warning(f"Session illisible ignorée: {mac}")
+                continue
+            logger.warning(f"Session au format obsolète: {mac}")
+            sessions[mac] = {
+                "username": raw.partition(b":")[0].decode(),
+                "login_time": 0
+            }
+        return sessions
     
-    async def revoke_session(self, mac: str, username: str):
-        """Révoque une session complète."""
-        logger.info(f"Révocation session: {username} ({mac})")
+    async def revoke_macs_nftables(self, macs: List[str]) -> Dict[str, bool]:
+        """Révoque des MAC via nftables, en une transaction `nft -f -` par paquet."""
+        results = {}
+        for i in range(0, len(macs), NFT_DELETE_CHUNK):
+            chunk = macs[i:i + NFT_DELETE_CHUNK]
+            try:
+                results.update(await apply_elements(
+                    "delete", settings.nft_table, settings.nft_chain,
+                    settings.nft_set, chunk
+                ))
+            except Exception as e:
+                logger.error(f"Erreur revoke nftables ({len(chunk)} MAC): {e}")
+                results.update(dict.fromkeys(chunk, False))
+        return results
+    
+    async def revoke_sessions(self, sessions: List[Tuple[str, str]]):
+        """Révoque des sessions complètes : Redis en parallèle, puis nft par lot."""
+        if not sessions:
+            return
+        
+        # Suppressions Redis en parallèle, concurrence bornée
+        sem = asyncio.Semaphore(REVOKE_CONCURRENCY)
         
-        # Supprimer de Redis
-        await self.redis_client.delete(f"session:{mac}")
+        async def _delete(mac: str, username: str):
+            async with sem:
+                logger.info(f"Révocation session: {username} ({mac})")
+                await self.redis_client.delete(f"session:{mac}")
+        
+        await asyncio.gather(*(_delete(mac, username) for mac, username in sessions))
         
         # Révoquer l'accès réseau
         if settings.auth_method == "nftables":
-            await self.revoke_mac_nftables(mac)
+            await self.revoke_macs_nftables([mac for mac, _ in sessions])
+    
+    async def revoke_session(self, mac: str, username: str):
+        """Révoque une session complète."""
+        await self.revoke_sessions([(mac, username)])
     
     async def sync(self):
         """Synchronise les sessions."""
@@ -201,26 +355,33 @@ class SessionSynchronizer:
         try:
             # Récupérer les sessions des deux côtés
             portal_sessions = await self.get_portal_sessions()
-            keycloak_sessions = await self.keycloak.get_active_sessions()
+            fetched_at, keycloak_sessions = await self.keycloak.get_active_sessions_snapshot(
+                max_age=self.interval
+            )
             
             # Créer un set des usernames avec session Keycloak active
-            active_users = set()
-            for session in keycloak_sessions:
-                active_users.add(session.get("username"))
+            active_users = {session.get("username") for session in keycloak_sessions}
             
             logger.info(f"Sessions portail: {len(portal_sessions)}, Sessions Keycloak: {len(active_users)}")
             
-            # Vérifier chaque session portail
-            revoked = 0
+            # Indexer les sessions portail par utilisateur, en une passe
+            portal_by_user = defaultdict(list)
             for mac, session_data in portal_sessions.items():
-                username = session_data["username"]
-                
-                # Si l'utilisateur n'a plus de session Keycloak active
-                if username not in active_users:
-                    await self.revoke_session(mac, username)
-                    revoked += 1
+                portal_by_user[session_data["username"]].append((mac, session_data["login_time"]))
+            
+            # Sessions portail dont l'utilisateur n'a plus de session Keycloak active.
+            # La liste Keycloak peut dater : une session portail ouverte après
+            # la prise de la liste n'est pas révoquée (elle le sera au cycle suivant)
+            to_revoke = [
+                (mac, username)
+                for username in portal_by_user.keys() - active_users
+                for mac, login_time in portal_by_user[username]
+                if login_time < fetched_at
+            ]
+            
+            await self.revoke_sessions(to_revoke)
             
-            logger.info(f"Synchronisation terminée. {revoked} sessions révoquées.")
+            logger.info(f"Synchronisation terminée. {len(to_revoke)} sessions révoquées.")
             
         except Exception as e:
             logger.error(f"Erreur synchronisation: {e}")
@@ -231,11 +392,14 @@ class SessionSynchronizer:
         # Redis TTL devrait gérer ça, mais au cas où
         portal_sessions = await self.get_portal_sessions()
         
+        to_revoke = []
         for mac, session_data in portal_sessions.items():
             ttl = await self.redis_client.ttl(f"session:{mac}")
             if ttl == -1:  # Pas de TTL défini
                 logger.warning(f"Session sans TTL: {mac}, suppression")
-                await self.revoke_session(mac, session_data["username"])
+                to_revoke.append((mac, session_data["username"]))
+        
+        await self.revoke_sessions(to_revoke)
 
 
 async def run_once():
@@ -251,7 +415,7 @@ async def run_once():
 
 async def run_daemon(interval: int):
     """Mode daemon."""
-    sync = SessionSynchronizer()
+    sync = SessionSynchronizer(interval)
     await sync.connect()
     
     logger.info(f"Daemon démarré, intervalle: {interval}s")